@@ -1,7 +1,9 @@
 import os
+import atexit
 import sqlite3
 import hashlib
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 from typing import List, Dict, Optional
 
@@ -15,21 +17,45 @@ from openai import OpenAI
 load_dotenv()
 st.set_page_config(page_title="RAG 專案管理後台（極簡版）", layout="wide")
 
+UPLOAD_WORKERS = 8
+FILES_PAGE_SIZE = 100
+
+SQLITE_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-65536;
+PRAGMA mmap_size=268435456;
+"""
+
 def now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
-def sha256_bytes(b: bytes) -> str:
-    h = hashlib.sha256()
-    h.update(b)
-    return h.hexdigest()
+def sha256_file(f) -> str:
+    """Hash a file-like object in blocks (no full-size bytes copy); rewinds it afterwards."""
+    f.seek(0)
+    if hasattr(hashlib, "file_digest"):  # Python 3.11+
+        digest = hashlib.file_digest(f, "sha256").hexdigest()
+    else:
+        h = hashlib.sha256()
+        for block in iter(lambda: f.read(1 << 16), b""):
+            h.update(block)
+        digest = h.hexdigest()
+    f.seek(0)
+    return digest
 
 def get_db_path() -> str:
     return os.getenv("RAG_DB_PATH", "rag_admin.db")
 
 @st.cache_resource
 def get_conn() -> sqlite3.Connection:
+    # cached resource: connect + schema setup run once per process, not on every rerun
     conn = sqlite3.connect(get_db_path(), check_same_thread=False)
+    conn.executescript(SQLITE_PRAGMAS)
     conn.row_factory = sqlite3.Row
+    init_db(conn)
+    # refresh planner stats on shutdown (cheap: only re-analyzes tables that need it)
+    atexit.register(conn.execute, "PRAGMA optimize")
     return conn
 
 def init_db(conn: sqlite3.Connection):
@@ -52,10 +78,20 @@ def init_db(conn: sqlite3.Connection):
       PRIMARY KEY (project_id, file_id),
       FOREIGN KEY (project_id) REFERENCES projects(project_id)
     );
-
-    CREATE INDEX IF NOT EXISTS idx_project_files_project ON project_files(project_id);
-    CREATE INDEX IF NOT EXISTS idx_project_files_sha256 ON project_files(sha256);
     """)
+
+    # one-time index migration: dedup lookups filter on (project_id, sha256);
+    # the single-column indexes are redundant with it (and with the PK prefix)
+    has_composite = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_pf_proj_sha'"
+    ).fetchone()
+    if not has_composite:
+        conn.executescript("""
+        CREATE INDEX idx_pf_proj_sha ON project_files(project_id, sha256);
+        DROP INDEX IF EXISTS idx_project_files_sha256;
+        DROP INDEX IF EXISTS idx_project_files_project;
+        ANALYZE project_files;
+        """)
     conn.commit()
 
 @st.cache_resource
@@ -67,9 +103,20 @@ def get_client() -> OpenAI:
     return OpenAI()
 
 conn = get_conn()
-init_db(conn)
 client = get_client()
 
+def cleanup_uploaded_files(vs_id: str, file_ids: List[str]):
+    """Best-effort: detach files from the vector store and delete them from OpenAI Files."""
+    for fid in file_ids:
+        try:
+            client.vector_stores.files.delete(vector_store_id=vs_id, file_id=fid)
+        except Exception:
+            pass  # may never have been attached
+        try:
+            client.files.delete(fid)
+        except Exception as e:
+            st.warning(f"無法刪除 OpenAI 檔案 {fid}：{e}")
+
 # -----------------------------
 # DB helpers
 # -----------------------------
@@ -80,6 +127,10 @@ def db_list_projects(active_only: bool = True) -> List[dict]:
         cur = conn.execute("SELECT * FROM projects ORDER BY updated_at DESC")
     return [dict(r) for r in cur.fetchall()]
 
+def db_get_project(project_id: str) -> Optional[dict]:
+    row = conn.execute("SELECT * FROM projects WHERE project_id=? LIMIT 1", (project_id,)).fetchone()
+    return dict(row) if row else None
+
 def db_create_project(name: str, vector_store_id: str) -> str:
     pid = str(uuid.uuid4())
     ts = now_iso()
@@ -102,28 +153,74 @@ def db_archive_project(project_id: str):
                  (ts, project_id))
     conn.commit()
 
-def db_list_project_files(project_id: str) -> List[dict]:
+def db_list_project_files(project_id: str, limit: int = -1, offset: int = 0) -> List[dict]:
+    # limit=-1 means "no limit" in SQLite
     cur = conn.execute("""
         SELECT project_id, file_id, filename, sha256, added_at
         FROM project_files
         WHERE project_id=?
-        ORDER BY added_at DESC
-    """, (project_id,))
+        ORDER BY added_at DESC, file_id
+        LIMIT ? OFFSET ?
+    """, (project_id, limit, offset))
     return [dict(r) for r in cur.fetchall()]
 
-def db_add_project_file(project_id: str, file_id: str, filename: str, sha256: Optional[str]):
-    ts = now_iso()
-    conn.execute("""
-        INSERT OR REPLACE INTO project_files(project_id, file_id, filename, sha256, added_at)
-        VALUES(?,?,?,?,?)
-    """, (project_id, file_id, filename, sha256, ts))
-    conn.commit()
+def db_count_project_files(project_id: str) -> int:
+    cur = conn.execute("SELECT COUNT(*) FROM project_files WHERE project_id=?", (project_id,))
+    return cur.fetchone()[0]
+
+def db_add_project_files_bulk(rows: List[tuple]):
+    """rows: (project_id, file_id, filename, sha256, added_at); one transaction, one commit."""
+    with conn:
+        conn.executemany("""
+            INSERT OR REPLACE INTO project_files(project_id, file_id, filename, sha256, added_at)
+            VALUES(?,?,?,?,?)
+        """, rows)
+    conn.execute("ANALYZE project_files")
 
 def db_remove_project_file(project_id: str, file_id: str):
     conn.execute("DELETE FROM project_files WHERE project_id=? AND file_id=?",
                  (project_id, file_id))
     conn.commit()
 
+def db_invalidate_answer_cache(project_id: str):
+    """
+    Drop cached chat answers after a project's files change. The answer_cache table (owned by
+    rag_core) is authoritative for every process, so deleting here is enough even when the
+    API server is not running.
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='answer_cache'"
+    ).fetchone()
+    if exists:
+        conn.execute("DELETE FROM answer_cache WHERE project_id=?", (project_id,))
+        conn.commit()
+
+def db_diff_remote_files(project_id: str, remote_pages) -> tuple:
+    """
+    remote_pages: iterable of file_id lists (one per API page).
+    Returns (missing_in_remote, missing_in_local), diffed in SQL via a TEMP table.
+    """
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS remote_ids(file_id TEXT PRIMARY KEY)")
+    try:
+        with conn:
+            conn.execute("DELETE FROM remote_ids")
+            for ids in remote_pages:
+                conn.executemany("INSERT OR IGNORE INTO remote_ids(file_id) VALUES(?)", [(i,) for i in ids])
+
+        missing_in_remote = [r[0] for r in conn.execute("""
+            SELECT file_id FROM project_files WHERE project_id=?
+            EXCEPT SELECT file_id FROM remote_ids
+            ORDER BY 1
+        """, (project_id,))]
+        missing_in_local = [r[0] for r in conn.execute("""
+            SELECT file_id FROM remote_ids
+            EXCEPT SELECT file_id FROM project_files WHERE project_id=?
+            ORDER BY 1
+        """, (project_id,))]
+    finally:
+        conn.execute("DROP TABLE IF EXISTS temp.remote_ids")
+    return missing_in_remote, missing_in_local
+
 def db_has_sha_in_project(project_id: str, sha: str) -> bool:
     cur = conn.execute("""
         SELECT 1 FROM project_files WHERE project_id=? AND sha256=? LIMIT 1
@@ -166,10 +263,12 @@ with st.sidebar.expander("➕ 新增專案", expanded=False):
 
 with st.sidebar.expander("✏️ 專案改名 / 封存", expanded=False):
     pid = st.session_state.selected_project_id
+    proj = db_get_project(pid) if pid else None
     if not pid:
         st.info("先選一個專案")
+    elif not proj:
+        st.warning("找不到此專案，請重新選擇。")
     else:
-        proj = [p for p in db_list_projects(active_only=False) if p["project_id"] == pid][0]
         rename_to = st.text_input("新名稱", value=proj["project_name"])
         if st.button("更新名稱"):
             db_rename_project(pid, rename_to.strip())
@@ -194,7 +293,10 @@ if not pid:
     st.warning("請先在左側選擇或建立專案。")
     st.stop()
 
-project = [p for p in db_list_projects(active_only=False) if p["project_id"] == pid][0]
+project = db_get_project(pid)
+if not project:
+    st.warning("找不到此專案，請重新選擇。")
+    st.stop()
 vs_id = project["vector_store_id"]
 
 st.subheader(f"目前專案：{project['project_name']}  |  VS: {vs_id}")
@@ -217,37 +319,84 @@ with tab_upload:
         do = st.button("🚀 上傳並加入 Vector Store（開始索引）", disabled=not uploads)
 
     if do:
+        # 1) hash + dedup check locally
+        # (also dedup within this batch: nothing is in the DB until the batch is recorded)
+        to_upload = []
+        seen = set()
         for uf in uploads:
+            sha = sha256_file(uf)
+            if dedup and (sha in seen or db_has_sha_in_project(pid, sha)):
+                st.info(f"略過（同專案已存在相同內容）：{uf.name}")
+                continue
+            seen.add(sha)
+            to_upload.append((uf, sha))
+
+        # 2) upload to OpenAI Files in parallel (I/O-bound -> threads)
+        uploaded = []  # (uf, sha, file_id)
+        if to_upload:
+            with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as ex:
+                futures = {
+                    ex.submit(client.files.create, file=(uf.name, uf), purpose="assistants"): (uf, sha)
+                    for uf, sha in to_upload
+                }
+                for fut in as_completed(futures):
+                    uf, sha = futures[fut]
+                    try:
+                        uploaded.append((uf, sha, fut.result().id))
+                    except Exception as e:
+                        st.error(f"❌ {uf.name} 上傳失敗：{e}")
+
+        if uploaded:
+            name_of = {fid: uf.name for uf, _, fid in uploaded}
             try:
-                data = uf.getvalue()
-                sha = sha256_bytes(data)
-
-                if dedup and db_has_sha_in_project(pid, sha):
-                    st.info(f"略過（同專案已存在相同內容）：{uf.name}")
-                    continue
-
-                # 1) upload to OpenAI Files
-                f = client.files.create(file=(uf.name, data), purpose="assistants")
-
-                # 2) add to vector store (index)
-                client.vector_stores.file_batches.create(vector_store_id=vs_id, file_ids=[f.id])
-
-                # 3) record mapping locally
-                db_add_project_file(pid, f.id, uf.name, sha)
-
-                st.success(f"✅ {uf.name} → file_id={f.id}（已加入索引）")
+                # 3) add to vector store (index) in ONE batch call; wait until indexing finishes
+                with st.spinner("索引中..."):
+                    batch = client.vector_stores.file_batches.create_and_poll(
+                        vector_store_id=vs_id,
+                        file_ids=list(name_of),
+                    )
+                indexed_ids = {
+                    f.id for f in client.vector_stores.file_batches.list_files(
+                        batch_id=batch.id, vector_store_id=vs_id, filter="completed"
+                    )
+                }
             except Exception as e:
-                st.error(f"❌ {uf.name} 失敗：{e}")
+                # batch state unknown (e.g. poll timeout): detach + delete what we uploaded,
+                # so nothing is left in the vector store without a DB mapping
+                st.error(f"❌ 加入 Vector Store 失敗：{e}")
+                cleanup_uploaded_files(vs_id, list(name_of))
+                st.warning("已撤回本次上傳的檔案：" + "、".join(name_of.values()))
+            else:
+                # 4) record mapping locally (single transaction), only for files that indexed
+                ts = now_iso()
+                db_add_project_files_bulk([
+                    (pid, fid, uf.name, sha, ts) for uf, sha, fid in uploaded if fid in indexed_ids
+                ])
+                # only now: answers cached during indexing would miss the new documents
+                db_invalidate_answer_cache(pid)
+
+                for uf, _, fid in uploaded:
+                    if fid in indexed_ids:
+                        st.success(f"✅ {uf.name} → file_id={fid}（已加入索引）")
+
+                failed_ids = [fid for fid in name_of if fid not in indexed_ids]
+                if failed_ids:
+                    cleanup_uploaded_files(vs_id, failed_ids)
+                    for fid in failed_ids:
+                        st.error(f"❌ {name_of[fid]} 索引失敗（status={batch.status}），已撤回")
 
 # -----------------------------
 # Tab 2: list project files from DB, remove from vector store + db
 # -----------------------------
 with tab_list:
     st.markdown("### ② 專案檔案清單（地端 mapping）")
-    rows = db_list_project_files(pid)
-    if not rows:
+    total = db_count_project_files(pid)
+    if not total:
         st.info("此專案尚未加入任何檔案。")
     else:
+        n_pages = (total + FILES_PAGE_SIZE - 1) // FILES_PAGE_SIZE
+        page = st.number_input(f"頁數（共 {n_pages} 頁 / {total} 筆）", min_value=1, max_value=n_pages, value=1, step=1)
+        rows = db_list_project_files(pid, limit=FILES_PAGE_SIZE, offset=(int(page) - 1) * FILES_PAGE_SIZE)
         st.dataframe(rows, use_container_width=True, hide_index=True)
 
     st.divider()
@@ -261,6 +410,7 @@ with tab_list:
             # 這裡採用 vector_stores.files.delete( vector_store_id, file_id=... )
             client.vector_stores.files.delete(vector_store_id=vs_id, file_id=file_id.strip())
             db_remove_project_file(pid, file_id.strip())
+            db_invalidate_answer_cache(pid)
             st.success("已從專案移除")
             st.rerun()
         except Exception as e:
@@ -275,34 +425,42 @@ with tab_sync:
 
     if st.button("🔄 從 OpenAI 讀取 vector store 檔案並對帳"):
         try:
-            # OpenAI: list files in vector store
-            remote = client.vector_stores.files.list(vector_store_id=vs_id, limit=200).data
-            remote_file_ids = set([r.file_id for r in remote])
-
-            local = db_list_project_files(pid)
-            local_file_ids = set([x["file_id"] for x in local])
-
-            missing_in_remote = sorted(list(local_file_ids - remote_file_ids))
-            missing_in_local = sorted(list(remote_file_ids - local_file_ids))
-
-            colA, colB = st.columns(2)
-            with colA:
-                st.markdown("#### DB 有，但 OpenAI VS 沒有（疑似被移除）")
-                st.write(missing_in_remote if missing_in_remote else "無")
-
-            with colB:
-                st.markdown("#### OpenAI VS 有，但 DB 沒有（疑似未登錄）")
-                st.write(missing_in_local if missing_in_local else "無")
-
-            # Optional: auto-fix DB from remote (only add missing_in_local)
-            st.divider()
-            if missing_in_local:
-                st.warning("你可以選擇把『OpenAI 有但 DB 沒有』的檔案補回 DB（只補 mapping，不影響 OpenAI）。")
-                if st.button("➕ 補回 DB mapping（用 file_id 當 filename）"):
-                    for fid in missing_in_local:
-                        db_add_project_file(pid, fid, filename=fid, sha256=None)
-                    st.success("已補回 DB")
-                    st.rerun()
-
+            # OpenAI: list ALL files in vector store (cursor pagination, 100 per page)
+            first_page = client.vector_stores.files.list(vector_store_id=vs_id, limit=100)
+            remote_pages = ([r.id for r in page.data] for page in first_page.iter_pages())
+
+            missing_in_remote, missing_in_local = db_diff_remote_files(pid, remote_pages)
+            # keep the result across reruns, so the fix button below can act on it
+            st.session_state.sync_result = {
+                "project_id": pid,
+                "missing_in_remote": missing_in_remote,
+                "missing_in_local": missing_in_local,
+            }
         except Exception as e:
+            st.session_state.sync_result = None
             st.error(f"同步失敗：{e}")
+
+    sync_result = st.session_state.get("sync_result")
+    if sync_result and sync_result["project_id"] == pid:
+        missing_in_remote = sync_result["missing_in_remote"]
+        missing_in_local = sync_result["missing_in_local"]
+
+        colA, colB = st.columns(2)
+        with colA:
+            st.markdown("#### DB 有，但 OpenAI VS 沒有（疑似被移除）")
+            st.write(missing_in_remote if missing_in_remote else "無")
+
+        with colB:
+            st.markdown("#### OpenAI VS 有，但 DB 沒有（疑似未登錄）")
+            st.write(missing_in_local if missing_in_local else "無")
+
+        # Optional: auto-fix DB from remote (only add missing_in_local)
+        st.divider()
+        if missing_in_local:
+            st.warning("你可以選擇把『OpenAI 有但 DB 沒有』的檔案補回 DB（只補 mapping，不影響 OpenAI）。")
+            if st.button("➕ 補回 DB mapping（用 file_id 當 filename）"):
+                ts = now_iso()
+                db_add_project_files_bulk([(pid, fid, fid, None, ts) for fid in missing_in_local])
+                st.session_state.sync_result = None
+                st.success("已補回 DB")
+                st.rerun()
@@ -0,0 +1,372 @@
+# RAG chat core, shared by api_server.py (HTTP) and ui_streamlit.py (in-process when RAG_INPROC=1).
+import os
+import json
+import hashlib
+import itertools
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from typing import Optional, Dict, Any, Iterator
+
+from cachetools import TTLCache
+from fastapi import HTTPException
+from pydantic import BaseModel, ConfigDict
+from dotenv import load_dotenv
+from openai import OpenAI
+
+# -----------------------------
+# Load env (.env)
+# -----------------------------
+load_dotenv()
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+if not OPENAI_API_KEY:
+    raise RuntimeError("OPENAI_API_KEY not found. Please set it in .env or environment variables.")
+
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
+# Optional: stored prompt (Prompts API). When set, instructions live server-side instead of
+# being sent with every request; INSTRUCTIONS below is then unused.
+OPENAI_PROMPT_ID = os.getenv("OPENAI_PROMPT_ID")
+DB_PATH = os.getenv("RAG_DB_PATH", "rag_admin.db")
+
+SQLITE_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-65536;
+PRAGMA mmap_size=268435456;
+"""
+
+# project_id -> vector_store_id is effectively immutable; re-check the DB at most once per TTL
+VS_CACHE_TTL = int(os.getenv("VS_CACHE_TTL", "60"))
+
+# exact-match answer cache:
+#   L2 SQLite table: authoritative and shared by every process on the DB (app.py invalidates it)
+#   L1 in-process:   trusted without touching SQLite for a short TTL, so an invalidation made
+#                    by another process shows up here at most ANSWER_CACHE_L1_TTL seconds late
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_L1_TTL = int(os.getenv("ANSWER_CACHE_L1_TTL", "10"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "2048"))
+ANSWER_CACHE_PRUNE_EVERY = 100  # puts between deletes of expired L2 rows
+
+# -----------------------------
+# OpenAI client
+# -----------------------------
+client = OpenAI(api_key=OPENAI_API_KEY)
+
+
+# -----------------------------
+# DB helpers
+# -----------------------------
+_db_conn: Optional[sqlite3.Connection] = None
+_db_conn_lock = threading.Lock()
+_db_write_lock = threading.Lock()
+
+
+def get_conn() -> sqlite3.Connection:
+    """
+    Shared, long-lived connection (opened lazily on first use, since the DB file is created by app.py).
+    Autocommit mode: reads are lock-free under WAL; writes go through db_write().
+
+    DB schema expectation (minimal):
+      - projects(project_id TEXT, vector_store_id TEXT, status TEXT)
+    The answer_cache table is owned by this module and created on first use.
+    """
+    global _db_conn
+    if _db_conn is not None:
+        return _db_conn
+    with _db_conn_lock:
+        if _db_conn is None:
+            if not os.path.exists(DB_PATH):
+                raise HTTPException(status_code=500, detail=f"DB file not found: {DB_PATH}")
+            conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+            conn.executescript(SQLITE_PRAGMAS)
+            conn.executescript("""
+            CREATE TABLE IF NOT EXISTS answer_cache (
+              key_hex TEXT PRIMARY KEY,
+              project_id TEXT NOT NULL,
+              answer_json TEXT NOT NULL,
+              created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_answer_cache_project ON answer_cache(project_id);
+            CREATE INDEX IF NOT EXISTS idx_answer_cache_created ON answer_cache(created_at);
+            """)
+            conn.row_factory = sqlite3.Row
+            _db_conn = conn
+            _prune_answer_cache(conn)
+    return _db_conn
+
+
+def _prune_answer_cache(conn: sqlite3.Connection) -> None:
+    """
+    Delete expired answer_cache rows (ANSWER_CACHE_SIZE only bounds L1, so L2 needs this).
+    """
+    try:
+        with _db_write_lock:
+            conn.execute("DELETE FROM answer_cache WHERE created_at<?", (time.time() - ANSWER_CACHE_TTL,))
+    except sqlite3.Error as e:
+        print(f"Answer cache prune error: {e}")
+
+
+def db_write(sql: str, params: tuple = ()) -> sqlite3.Cursor:
+    """
+    Single-statement write on the shared connection, serialized across worker threads.
+    """
+    with _db_write_lock:
+        return get_conn().execute(sql, params)
+
+
+def close_conn() -> None:
+    global _db_conn
+    with _db_conn_lock:
+        if _db_conn is not None:
+            _db_conn.execute("PRAGMA optimize")
+            _db_conn.close()
+            _db_conn = None
+
+
+@lru_cache(maxsize=1024)
+def _vs_lookup(project_id: str, ttl_bucket: int) -> str:
+    """
+    Cached DB lookup. `ttl_bucket` changes every VS_CACHE_TTL seconds, which expires old entries.
+    Errors are raised (and therefore not cached).
+    """
+    row = get_conn().execute(
+        "SELECT vector_store_id FROM projects WHERE project_id=? AND status='active'",
+        (project_id,),
+    ).fetchone()
+
+    if not row:
+        raise HTTPException(status_code=404, detail=f"project_id not found or inactive: {project_id}")
+
+    vs_id = row["vector_store_id"]
+    if not vs_id:
+        raise HTTPException(status_code=500, detail=f"vector_store_id is empty for project_id: {project_id}")
+    return vs_id
+
+
+def get_vector_store_id(project_id: str) -> str:
+    """
+    Lookup vector_store_id from local DB by project_id.
+    """
+    return _vs_lookup(project_id, int(time.monotonic() // VS_CACHE_TTL))
+
+
+def vs_cache_clear() -> None:
+    _vs_lookup.cache_clear()
+
+
+# -----------------------------
+# Request/Response models
+# -----------------------------
+class ChatReq(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
+    project_id: str
+    user_id: str
+    message: str
+
+
+class ChatResp(BaseModel):
+    # frozen blocks field reassignment only; the citations list itself is still mutable
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
+    answer: str
+    citations: list[dict] = []  # POC: keep empty; later parse annotations for filenames/pages
+
+
+# -----------------------------
+# Answer cache (L1: memory, L2: SQLite)
+# -----------------------------
+answer_cache: TTLCache = TTLCache(maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_L1_TTL)
+_answer_cache_puts = itertools.count(1)
+_answer_cache_lock = threading.Lock()  # cachetools caches are not thread-safe
+
+
+def _answer_key(project_id: str, message: str) -> str:
+    return hashlib.sha256(f"{project_id}|{OPENAI_MODEL}|{OPENAI_PROMPT_ID or ''}|{message}".encode("utf-8")).hexdigest()
+
+
+def answer_cache_get(project_id: str, message: str) -> Optional[ChatResp]:
+    """
+    L1 fast path first (no SQLite); on a miss, read L2 and refill L1.
+    """
+    key = _answer_key(project_id, message)
+    with _answer_cache_lock:
+        hit = answer_cache.get(key)
+    if hit is not None:
+        return hit
+
+    try:
+        row = get_conn().execute(
+            "SELECT answer_json FROM answer_cache WHERE key_hex=? AND created_at>=?",
+            (key, time.time() - ANSWER_CACHE_TTL),
+        ).fetchone()
+    except sqlite3.Error as e:
+        # best-effort: a cache problem must never fail a chat
+        print(f"Answer cache read error: {e}")
+        return None
+    if not row:
+        return None
+
+    resp = ChatResp(**json.loads(row["answer_json"]))
+    with _answer_cache_lock:
+        answer_cache[key] = resp
+    return resp
+
+
+def answer_cache_put(project_id: str, message: str, resp: ChatResp) -> None:
+    """
+    Best-effort: storage errors are logged and swallowed.
+    """
+    if not resp.answer:
+        return
+    key = _answer_key(project_id, message)
+    with _answer_cache_lock:
+        answer_cache[key] = resp
+
+    payload = json.dumps({"answer": resp.answer, "citations": resp.citations}, ensure_ascii=False)
+    try:
+        db_write(
+            "INSERT OR REPLACE INTO answer_cache(key_hex, project_id, answer_json, created_at) VALUES(?,?,?,?)",
+            (key, project_id, payload, time.time()),
+        )
+    except sqlite3.Error as e:
+        # best-effort: the answer is already good, e.g. app.py may just hold the write lock
+        print(f"Answer cache write error: {e}")
+
+    if next(_answer_cache_puts) % ANSWER_CACHE_PRUNE_EVERY == 0:
+        _prune_answer_cache(get_conn())
+
+
+def answer_cache_invalidate(project_id: Optional[str] = None) -> int:
+    """
+    Drop cached answers for one project (or everything). Returns number of L2 rows removed.
+    L1 is short-lived, so it is simply cleared as a whole.
+    """
+    with _answer_cache_lock:
+        answer_cache.clear()
+
+    if project_id is None:
+        cur = db_write("DELETE FROM answer_cache")
+    else:
+        cur = db_write("DELETE FROM answer_cache WHERE project_id=?", (project_id,))
+    return cur.rowcount
+
+
+# -----------------------------
+# Prompt (instructions)
+# -----------------------------
+INSTRUCTIONS = """你是一個企業對外的「專案 AI 助理」。
+
+語言規則：
+- 一律使用繁體中文回答。
+
+資料規則：
+- 只能依據 file_search 檢索到的文件內容回答。
+- 不可以臆測、杜撰或補充文件沒有提到的資訊。
+- 若文件中沒有相關資訊，請明確回答「文件未提供」，並說明需要哪類文件才能回答。
+
+引用規則：
+- 每個重點/結論都必須附「引用」：至少要能指出是哪些文件（檔名）支持該結論。
+- 若無法找到對應依據，請不要產生結論。
+
+建議回答格式：
+1) 重點結論，150字內
+"""
+
+
+# static part of every Responses API call, built once at import
+if OPENAI_PROMPT_ID:
+    _BASE_RESPONSE_KWARGS: Dict[str, Any] = {"model": OPENAI_MODEL, "prompt": {"id": OPENAI_PROMPT_ID}}
+else:
+    _BASE_RESPONSE_KWARGS = {"model": OPENAI_MODEL, "instructions": INSTRUCTIONS}
+
+
+def _response_kwargs(vs_id: str, message: str) -> Dict[str, Any]:
+    # IMPORTANT:
+    # Use the stable python-sdk-friendly format:
+    # Put vector_store_ids directly inside the file_search tool object.
+    return {
+        **_BASE_RESPONSE_KWARGS,
+        "input": message,
+        "tools": [
+            {
+                "type": "file_search",
+                "vector_store_ids": [vs_id],
+                # Optional knobs (uncomment if you want):
+                # "max_num_results": 8,
+            }
+        ],
+        # POC: stateless. If you want memory later, we can add store/conversation.
+    }
+
+
+# -----------------------------
+# Chat
+# -----------------------------
+def run_chat(req: ChatReq) -> ChatResp:
+    """
+    Minimal RAG chat.
+    - Reads vector_store_id from local DB by project_id
+    - Calls Responses API with file_search tool bound to that vector store
+    """
+    vs_id = get_vector_store_id(req.project_id)
+
+    cached = answer_cache_get(req.project_id, req.message)
+    if cached is not None:
+        return cached
+
+    try:
+        resp = client.responses.create(**_response_kwargs(vs_id, req.message))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"OpenAI call failed: {e}")
+
+    answer = getattr(resp, "output_text", None) or ""
+
+    # POC: citations empty for now.
+    # Later: parse resp.output[*].content[*].annotations to extract filenames/pages.
+    result = ChatResp(answer=answer, citations=[])
+    if getattr(resp, "status", None) == "completed":
+        answer_cache_put(req.project_id, req.message, result)
+    return result
+
+
+def run_chat_stream(req: ChatReq) -> Iterator[Dict[str, Any]]:
+    """
+    Streaming chat. Project lookup happens eagerly (errors raise here, before any event);
+    the returned iterator yields {"delta": "..."} events, then {"done": True, "citations": [...]}
+    or {"error": "..."}.
+    """
+    vs_id = get_vector_store_id(req.project_id)
+    cached = answer_cache_get(req.project_id, req.message)
+
+    def events() -> Iterator[Dict[str, Any]]:
+        if cached is not None:
+            yield {"delta": cached.answer}
+            yield {"done": True, "citations": cached.citations}
+            return
+
+        parts = []
+        completed = False
+        try:
+            with client.responses.stream(**_response_kwargs(vs_id, req.message)) as stream:
+                for event in stream:
+                    if event.type == "response.output_text.delta":
+                        parts.append(event.delta)
+                        yield {"delta": event.delta}
+                    elif event.type == "response.completed":
+                        completed = True
+                    elif event.type == "response.failed":
+                        yield {"error": "OpenAI response failed"}
+                        return
+        except Exception as e:
+            yield {"error": f"OpenAI call failed: {e}"}
+            return
+        # failed/incomplete (truncated) responses are delivered but never cached
+        if completed:
+            answer_cache_put(req.project_id, req.message, ChatResp(answer="".join(parts), citations=[]))
+        yield {"done": True, "citations": []}
+
+    return events()
@@ -1,9 +1,22 @@
 import os
 import io
-from google.cloud import speech
-from google.cloud import texttospeech
+import re
+import wave
+import functools
 from openai import OpenAI
-from pydub import AudioSegment
+
+TTS_CACHE_SIZE = 512
+
+# google-cloud / pydub are imported lazily inside the _google_* helpers,
+# so importing this module stays cheap when only OpenAI is used.
+_AudioSegment = None
+
+def _get_audio_segment():
+    global _AudioSegment
+    if _AudioSegment is None:
+        from pydub import AudioSegment
+        _AudioSegment = AudioSegment
+    return _AudioSegment
 
 def get_credentials_path():
     # Try current directory first
@@ -22,6 +35,7 @@ def init_google_clients():
         return None, None
     
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = creds_path
+    from google.cloud import speech, texttospeech
     
     speech_client = speech.SpeechClient()
     tts_client = texttospeech.TextToSpeechClient()
@@ -51,25 +65,77 @@ def text_to_speech(client, text, provider="google", language_code="zh-TW", voice
     Synthesizes text to audio bytes (MP3).
     provider: "google" or "openai"
     client: either google tts_client or openai_client
+    Results are memoized per (client, text, provider, language, voice); failures are not cached.
     """
+    try:
+        return _cached_tts(client, text, provider, language_code, voice_name)
+    except _TTSFailed:
+        return None
+
+class _TTSFailed(Exception):
+    pass
+
+@functools.lru_cache(maxsize=TTS_CACHE_SIZE)
+def _cached_tts(client, text, provider, language_code, voice_name):
+    # repeated phrases (greetings, "文件未提供"...) hit this cache instead of the API
+    audio = None
     if provider == "google":
-        return _google_tts(client, text, language_code, voice_name)
+        audio = _google_tts(client, text, language_code, voice_name)
     elif provider == "openai":
-        return _openai_tts(client, text, voice_name)
-    return None
+        audio = _openai_tts(client, text, voice_name)
+    if audio is None:
+        raise _TTSFailed()
+    return audio
+
+# CJK/"!?" end a sentence right away; "." only when followed by whitespace (keeps "3.5" intact)
+SENTENCE_END_RE = re.compile(r"[。！？!?]|\.(?=\s)")
+
+def pop_sentences(buffer):
+    """
+    Splits complete sentences off the front of a streaming text buffer.
+    Returns (sentences, rest) where rest is the trailing, not-yet-finished part.
+    """
+    sentences = []
+    start = 0
+    for m in SENTENCE_END_RE.finditer(buffer):
+        sentence = buffer[start:m.end()].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = m.end()
+    return sentences, buffer[start:]
 
 # --- Internal Google Impl ---
 
+def _wav_pcm16_mono(audio_bytes):
+    """
+    Returns (pcm_bytes, sample_rate) if audio_bytes is a mono PCM16 WAV, else None.
+    """
+    if audio_bytes[:4] != b"RIFF":
+        return None
+    try:
+        with wave.open(io.BytesIO(audio_bytes)) as w:
+            if w.getsampwidth() != 2 or w.getnchannels() != 1:
+                return None
+            return w.readframes(w.getnframes()), w.getframerate()
+    except (wave.Error, EOFError):
+        return None
+
 def _google_stt(speech_client, audio_bytes, language_code):
+    from google.cloud import speech
     try:
-        # Convert audio to LINEAR16 PCM, 16kHz, mono
-        audio = AudioSegment.from_file(io.BytesIO(audio_bytes))
-        audio = audio.set_frame_rate(16000).set_channels(1).set_sample_width(2)
-        pcm_bytes = audio.raw_data
+        # Fast path: mono PCM16 WAV (st.audio_input) goes straight through, no ffmpeg
+        wav = _wav_pcm16_mono(audio_bytes)
+        if wav:
+            pcm_bytes, sample_rate = wav
+        else:
+            # Convert audio to LINEAR16 PCM, 16kHz, mono
+            audio = _get_audio_segment().from_file(io.BytesIO(audio_bytes))
+            pcm_bytes = audio.set_frame_rate(16000).set_channels(1).set_sample_width(2).raw_data
+            sample_rate = 16000
 
         config = speech.RecognitionConfig(
             encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-            sample_rate_hertz=16000,
+            sample_rate_hertz=sample_rate,
             language_code=language_code,
             enable_automatic_punctuation=True,
         )
@@ -87,6 +153,7 @@ def _google_stt(speech_client, audio_bytes, language_code):
         return None
 
 def _google_tts(tts_client, text, language_code, voice_name):
+    from google.cloud import texttospeech
     try:
         synthesis_input = texttospeech.SynthesisInput(text=text)
         if voice_name:
@@ -150,4 +217,3 @@ def _openai_tts(client, text, voice_name="alloy"):
     except Exception as e:
         print(f"OpenAI TTS Error: {e}")
         return None
-
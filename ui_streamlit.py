@@ -1,8 +1,15 @@
 import os
+import json
+import hashlib
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import streamlit as st
+from cachetools import LRUCache
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # 新增引用: STT/TTS 工具模組
 import stt_tts_utils
@@ -12,6 +19,9 @@ st.set_page_config(page_title="API 測試 UI（RAG 助理 + 語音）", layout="
 
 API_BASE = os.getenv("API_BASE", "http://127.0.0.1:8000")
 DB_PATH = os.getenv("RAG_DB_PATH", "rag_admin.db")
+RAG_INPROC = os.getenv("RAG_INPROC") == "1"
+TTS_WORKERS = 4
+AUDIO_STORE_BYTES = 64 * 1024 * 1024
 
 # 初始化 Google Clients (Lazy load or at startup)
 @st.cache_resource
@@ -30,21 +40,138 @@ def get_openai_client():
 
 openai_client = get_openai_client()
 
+# 共用 HTTP Session（keep-alive + connection pool），避免每次 /chat 都重新 TCP/TLS 握手
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    s = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        max_retries=Retry(total=2, backoff_factor=0.2),
+    )
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+def iter_chat_events(payload):
+    """
+    Yields chat events ({"delta"} ..., then {"done"} or {"error"}).
+    RAG_INPROC=1: call rag_core directly (UI and API on the same host; no HTTP/JSON roundtrip).
+    Otherwise: POST /chat/stream and parse the SSE lines.
+    """
+    if RAG_INPROC:
+        import rag_core
+        yield from rag_core.run_chat_stream(rag_core.ChatReq(**payload))
+        return
+
+    with get_http_session().post(
+        f"{st.session_state.api_base}/chat/stream", json=payload, stream=True, timeout=60
+    ) as r:
+        r.raise_for_status()
+        for raw in r.iter_lines():
+            if not raw or not raw.startswith(b"data: "):
+                continue
+            yield json.loads(raw[len(b"data: "):].decode("utf-8"))
+
+def iter_chat_stream(payload, meta):
+    """
+    Yields text deltas of the answer.
+    Final citations are stored into meta["citations"].
+    """
+    for event in iter_chat_events(payload):
+        if "delta" in event:
+            yield event["delta"]
+        elif "error" in event:
+            raise RuntimeError(event["error"])
+        elif event.get("done"):
+            meta["citations"] = event.get("citations", [])
+
+def tee_sentences(deltas, on_sentence):
+    """
+    Passes deltas through unchanged, calling on_sentence() for each completed sentence.
+    """
+    buffer = ""
+    for delta in deltas:
+        buffer += delta
+        sentences, buffer = stt_tts_utils.pop_sentences(buffer)
+        for sentence in sentences:
+            on_sentence(sentence)
+        yield delta
+    if buffer.strip():
+        on_sentence(buffer.strip())
+
+# 共用 TTS 執行緒池（SDK 皆為同步 I/O，用 threads 與 LLM 串流並行即可）
+@st.cache_resource
+def get_tts_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="tts")
+
+def stream_answer(payload, synthesize=None):
+    """
+    Streams the /chat answer into the page.
+    If synthesize(sentence) is given, every finished sentence is submitted to the TTS pool
+    while the LLM keeps generating, so synthesis overlaps generation.
+    Returns (answer, citations, tts_futures) with futures in sentence order.
+    """
+    meta = {}
+    tts_futures = []
+    deltas = iter_chat_stream(payload, meta)
+    if synthesize is not None:
+        pool = get_tts_pool()
+        deltas = tee_sentences(deltas, lambda sentence: tts_futures.append(pool.submit(synthesize, sentence)))
+    answer = st.write_stream(deltas) or ""
+    return answer, meta.get("citations", []), tts_futures
+
+def audio_fingerprint(audio_bytes):
+    return hashlib.blake2b(audio_bytes, digest_size=16).hexdigest()
+
+@st.cache_data(ttl=600, max_entries=64, show_spinner=False)
+def transcribe(audio_fp, provider, language_code, _client, _audio_bytes):
+    """
+    STT keyed on the audio fingerprint (underscored args are not hashed by Streamlit).
+    Failures raise so that they are not cached.
+    """
+    transcript = stt_tts_utils.speech_to_text(_client, _audio_bytes, provider=provider, language_code=language_code)
+    if not transcript:
+        raise RuntimeError("STT returned no transcript")
+    return transcript
+
+# TTS 音檔放在 process-wide LRU，以總位元組數為上限（所有 session 共用，超過上限時淘汰最舊的音檔），
+# session_state 只存 fingerprint
+@st.cache_resource
+def get_audio_store():
+    return LRUCache(maxsize=AUDIO_STORE_BYTES, getsizeof=len), threading.Lock()
+
+def put_audio(audio_bytes):
+    fp = audio_fingerprint(audio_bytes)
+    store, lock = get_audio_store()
+    if len(audio_bytes) <= store.maxsize:  # LRUCache raises ValueError for a single oversized item
+        with lock:
+            store[fp] = audio_bytes
+    return fp
+
+def get_audio(fp):
+    if not fp:
+        return None
+    store, lock = get_audio_store()
+    with lock:
+        return store.get(fp)
+
 def get_conn():
     conn = sqlite3.connect(DB_PATH, check_same_thread=False)
     conn.row_factory = sqlite3.Row
     return conn
 
+# 專案清單快取 30 秒（app.py 在另一個 process 改動時無法主動通知，以 TTL 作為過期上限）
+@st.cache_data(ttl=30)
 def list_projects():
+    conn = get_conn()
     try:
-        conn = get_conn()
         rows = conn.execute(
             "SELECT project_id, project_name, vector_store_id FROM projects WHERE status='active' ORDER BY updated_at DESC"
         ).fetchall()
-        return [dict(r) for r in rows]
-    except Exception:
-        # 如果你還沒用 DB，也可以改成手動輸入 project_id / vector_store_id
-        return []
+    finally:
+        conn.close()
+    return [dict(r) for r in rows]
 
 st.title("API 測試 (Text & Voice)")
 
@@ -53,7 +180,13 @@ with st.sidebar:
     st.text_input("API Base", value=API_BASE, key="api_base")
     st.text_input("User ID（測試用）", value="test-user-001", key="user_id")
 
-    projects = list_projects()
+    if st.button("🔄 重新整理專案清單"):
+        list_projects.clear()
+    try:
+        projects = list_projects()
+    except Exception:
+        # 如果你還沒用 DB，也可以改成手動輸入 project_id / vector_store_id（失敗不快取）
+        projects = []
     if projects:
         labels = [f"{p['project_name']} · {p['project_id'][:8]}" for p in projects]
         idx = st.selectbox("選擇專案", range(len(labels)), format_func=lambda i: labels[i])
@@ -72,7 +205,7 @@ with st.sidebar:
 
 st.divider()
 
-# Migrate history structure if needed (tuple -> dict)
+# Migrate history structure if needed (tuple -> dict, inline audio bytes -> audio_fp)
 if "history" not in st.session_state:
     st.session_state.history = []
 else:
@@ -80,8 +213,12 @@ else:
     new_history = []
     for item in st.session_state.history:
         if isinstance(item, tuple):
-            new_history.append({"role": item[0], "content": item[1], "audio": None})
+            new_history.append({"role": item[0], "content": item[1], "audio_fp": None})
         elif isinstance(item, dict):
+            if "audio" in item:
+                item = dict(item)
+                audio = item.pop("audio")
+                item["audio_fp"] = put_audio(audio) if audio else None
             new_history.append(item)
     st.session_state.history = new_history
 
@@ -89,12 +226,16 @@ else:
 for msg in st.session_state.history:
     role = msg["role"]
     content = msg["content"]
-    audio = msg.get("audio")
+    audio_fp = msg.get("audio_fp")
+    audio = get_audio(audio_fp)
     
     with st.chat_message(role):
         st.markdown(content)
         if audio:
             st.audio(audio, format="audio/mp3")
+        elif audio_fp:
+            # 音檔存放於全 process 共用的 LRU，舊的回合可能已被淘汰
+            st.caption("（語音已過期，無法重播）")
 
 # --------------------------
 # 輸入區：支援 文字 (`st.chat_input`) 與 語音 (`st.audio_input`)
@@ -106,20 +247,7 @@ if speech_client:
     # 這裡使用 st.audio_input (Streamlit 1.40+)
     # 若版本較舊可能會報錯，請 user 升級
     audio_wav = st.audio_input("🎤 按下錄音發問")
-    if audio_wav:
-        # 當有錄音時，進行 STT
-        with st.spinner("語音辨識中..."):
-            audio_bytes = audio_wav.getvalue()
-            # 簡單做個 cache check 機制避免重複送出? 
-            # Streamlit 每次 rerun 若 audio_wav 沒變，會重複 process?
-            # 通常 st.audio_input 在錄製完後會觸發 rerun。
-            # 為了避免同一段錄音重複觸發，可以在 session_state 記住上一次處理的 audio bytes
-            
-            # (這裡做個簡易判斷：計算 hash 或直接比對 bytes)
-            # 但為了簡單，這裡先不做過度複雜的防呆，假設使用者錄完就是想問。
-            # 不過 Streamlit 的 audio_input 會保留狀態，直到點叉叉。
-            # 我們需要一個機制來判斷「這是新錄的」。
-            pass # 後面邏輯處理
+    # STT 在下方判斷邏輯執行（以 fingerprint 避免同一段錄音重複辨識）
 
 # 2. 文字輸入
 text_prompt = st.chat_input("輸入問題（例如：請列出目前專案 Top 3 風險並附引用）")
@@ -131,28 +259,34 @@ is_voice_input = False
 if text_prompt:
     final_prompt = text_prompt
 elif speech_client and audio_wav:
-    # 檢查是否已處理過這段音訊
-    if "last_audio_bytes" not in st.session_state:
-        st.session_state.last_audio_bytes = None
+    # 檢查是否已處理過這段音訊（只存 32 字元的 fingerprint，不存/比對整段 bytes）
+    if "last_audio_fp" not in st.session_state:
+        st.session_state.last_audio_fp = None
     
     current_audio_bytes = audio_wav.getvalue()
-    if current_audio_bytes != st.session_state.last_audio_bytes:
+    audio_fp = audio_fingerprint(current_audio_bytes)
+    if audio_fp != st.session_state.last_audio_fp:
         # 這是新的錄音 -> 執行 STT
         # 根據選擇的 Provider 傳入對應 Client
         # Google: speech_client, OpenAI: openai_client
         current_client = speech_client if stt_provider == "Google" else openai_client
         provider_code = stt_provider.lower()
         
-        transcript = stt_tts_utils.speech_to_text(
-            current_client, 
-            current_audio_bytes, 
-            provider=provider_code,
-            language_code="cmn-Hant-TW" if voice_language=="zh-TW" else "en-US"
-        )
+        try:
+            with st.spinner("語音辨識中..."):
+                transcript = transcribe(
+                    audio_fp,
+                    provider_code,
+                    "cmn-Hant-TW" if voice_language=="zh-TW" else "en-US",
+                    current_client,
+                    current_audio_bytes,
+                )
+        except RuntimeError:
+            transcript = None
         if transcript:
             final_prompt = transcript
             is_voice_input = True
-            st.session_state.last_audio_bytes = current_audio_bytes
+            st.session_state.last_audio_fp = audio_fp
         else:
             st.warning("無法辨識語音，請重試。")
     else:
@@ -161,7 +295,7 @@ elif speech_client and audio_wav:
 
 if final_prompt:
     # 1. 顯示使用者問題
-    st.session_state.history.append({"role": "user", "content": final_prompt, "audio": None})
+    st.session_state.history.append({"role": "user", "content": final_prompt, "audio_fp": None})
     with st.chat_message("user"):
         st.markdown(final_prompt)
 
@@ -172,17 +306,27 @@ if final_prompt:
         "user_id": st.session_state.user_id
     }
 
+    # TTS (若啟用)：根據 Provider 選擇 Client（Google: tts_client, OpenAI: openai_client）
+    synthesize = None
+    tts_current_client = tts_client if stt_provider == "Google" else openai_client
+    if enable_voice_response and tts_current_client is not None:
+        tts_provider_code = stt_provider.lower()
+
+        def synthesize(sentence):
+            return stt_tts_utils.text_to_speech(
+                tts_current_client,
+                sentence,
+                provider=tts_provider_code,
+                language_code=voice_language,
+            )
+
     try:
         with st.chat_message("assistant"):
-            with st.spinner("呼叫 API 中..."):
-                r = requests.post(f"{st.session_state.api_base}/chat", json=payload, timeout=60)
-                r.raise_for_status()
-                data = r.json()
-
-            answer = data.get("answer", "")
-            citations = data.get("citations", [])
+            # 3. 串流顯示回答；每湊滿一句就丟去 TTS（與生成並行）
+            answer, citations, tts_futures = stream_answer(payload, synthesize)
 
-            st.markdown(answer if answer else "(無回覆)")
+            if not answer:
+                st.markdown("(無回覆)")
 
             if citations:
                 st.markdown("#### 引用")
@@ -197,35 +341,25 @@ if final_prompt:
                     if quote:
                         st.caption(quote)
 
-            # 3. TTS (若啟用)
+            # 4. 收齊語音（多數句子在串流期間已合成完）
             tts_audio = None
-            if enable_voice_response and answer:
-                # 根據 Provider 選擇 Client
-                # Google: tts_client, OpenAI: openai_client
-                current_client = tts_client if stt_provider == "Google" else openai_client
-                provider_code = stt_provider.lower()
-                
-                # 若 client 存在才執行
-                if current_client:
-                    with st.spinner("生成語音中..."):
-                        tts_audio = stt_tts_utils.text_to_speech(
-                            current_client, 
-                            answer, 
-                            provider=provider_code, 
-                            language_code=voice_language
-                        )
-                        if tts_audio:
-                            st.audio(tts_audio, format="audio/mp3")
+            if tts_futures:
+                with st.spinner("生成語音中..."):
+                    # MP3 frames can be concatenated as-is
+                    chunks = [f.result() for f in tts_futures]
+                    tts_audio = b"".join(c for c in chunks if c) or None
+                    if tts_audio:
+                        st.audio(tts_audio, format="audio/mp3")
 
             st.session_state.history.append({
                 "role": "assistant", 
                 "content": answer if answer else "(無回覆)",
-                "audio": tts_audio
+                "audio_fp": put_audio(tts_audio) if tts_audio else None
             })
 
     except Exception as e:
         err = f"API 呼叫失敗：{e}"
         with st.chat_message("assistant"):
             st.error(err)
-        st.session_state.history.append({"role": "assistant", "content": err, "audio": None})
+        st.session_state.history.append({"role": "assistant", "content": err, "audio_fp": None})
 